@@ -2,12 +2,17 @@
 
 import os
 import logging
+import functools
 import sys
 from datetime import date, timedelta, datetime
 import requests
-import json
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import orjson
 import time
 import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 START_HOUR = "08"
 END_HOUR = "18"
@@ -15,8 +20,34 @@ MAIL_USER = os.getenv("MAIL_USER")
 PLATE_NUMBER = os.getenv("PLATE_NUMBER")
 PASSWORD = os.getenv("PASSWORD_PARKING")
 LOCATION_IDS = ["19", "29"]
+FORBIDDEN_SPACES = frozenset({"2592", "2591"})
 BASE_URL = os.getenv("BASE_URL")
 BOOKING_DATE = os.getenv("BOOKING_DATE")
+HTTP_RETRY = Retry(
+    total=3,
+    backoff_factor=0.3,
+    status_forcelist=(500, 502, 503, 504),
+    allowed_methods=frozenset(["POST"])
+)
+# create-event is not idempotent: only retry connection failures, never a request that may have reached the server
+BOOKING_RETRY = Retry(
+    total=3,
+    read=0,
+    status=0,
+    other=0,
+    backoff_factor=0.3,
+    allowed_methods=frozenset(["POST"])
+)
+SPACES_CACHE_TTL = 3  # seconds
+INITIAL_RETRY_DELAY = 0.5  # seconds
+MAX_RETRY_DELAY = 8.0  # seconds
+RETRY_BACKOFF_FACTOR = 1.7
+MAX_FAILED_FETCH_CYCLES = 3
+WARM_UP_TIMEOUT = 2  # seconds
+PERMANENT_FETCH_STATUSES = frozenset({400, 401, 403, 404})
+
+_spaces_cache = {}
+_login_lock = threading.Lock()
 
 logging.basicConfig(
     level=logging.INFO,
@@ -28,7 +59,7 @@ logging.basicConfig(
 
 def get_target_date() -> str | None:
     if BOOKING_DATE:
-        logging.info(f"Manual booking date override detected: {BOOKING_DATE}")
+        logging.info("Manual booking date override detected: %s", BOOKING_DATE)
         return BOOKING_DATE
     today = date.today()
     day_of_week = today.weekday()  # Monday is 0, Sunday is 6
@@ -42,84 +73,136 @@ def get_target_date() -> str | None:
         return None
 
     target_date = today + timedelta(days=days_to_add)
-    logging.debug(f"Target date: {target_date.strftime('%Y-%m-%d')}")
+    logging.debug("Target date: %s", target_date)
     return target_date.strftime("%Y-%m-%d")
 
+@functools.lru_cache(maxsize=16)
+def build_dates_json(target_date: str) -> tuple[str, str, str]:
+    start_time = f"{target_date}T{START_HOUR}:00+01:00"
+    end_time = f"{target_date}T{END_HOUR}:00+01:00"
+    dates_json = orjson.dumps([{"startTime": start_time, "endTime": end_time}]).decode()
+    return start_time, end_time, dates_json
+
+def warm_connection(session: requests.Session) -> None:
+    try:
+        session.head(BASE_URL, timeout=WARM_UP_TIMEOUT)
+    except requests.exceptions.RequestException as e:
+        logging.debug("Connection warm-up failed: %s", e)
+
 def login(session: requests.Session) -> str | None:
     logging.info("Attempting to log in...")
     login_url = f"{BASE_URL}/login"
     payload = {
-        "username": f"{MAIL_USER}",
+        "username": MAIL_USER,
         "password": PASSWORD
     }
     try:
         response = session.post(login_url, data=payload)
         response.raise_for_status()
-        token = response.json().get("accessToken")
+        token = orjson.loads(response.content).get("accessToken")
         if token:
             logging.info("Login successful. Token acquired.")
             return token
         else:
-            logging.error(f"Login failed. 'accessToken' not in response. Response: {response.text}")
+            logging.error("Login failed. 'accessToken' not in response. Response: %s", response.text)
             return None
     except requests.exceptions.RequestException as e:
-        logging.error(f"An error occurred during login: {e}")
+        logging.error("An error occurred during login: %s", e)
+        return None
+    except orjson.JSONDecodeError as e:
+        logging.error("Failed to parse login response: %s. Response: %s", e, response.text)
         return None
 
-def get_available_spaces(session: requests.Session, token: str, target_date: str, location_id: str) -> list[str]:
-    logging.info(f"Fetching available spaces for {target_date} at location {location_id}...")
-    search_url = f"{BASE_URL}/api/2.0/search-resource"
-    headers = {"Authorization": f"Bearer {token}"}
+def post_auth(session: requests.Session, url: str, payload: dict) -> requests.Response:
+    sent_authorization = session.headers.get("Authorization")
+    response = session.post(url, data=payload)
+    if response.status_code == 401:
+        with _login_lock:
+            # Another thread may have already refreshed the token while this request was in flight
+            if session.headers.get("Authorization") == sent_authorization:
+                logging.warning("Access token rejected. Logging in again...")
+                token = login(session)
+                if not token:
+                    return response
+                session.headers["Authorization"] = f"Bearer {token}"
+        response = session.post(url, data=payload)
+    return response
 
-    start_time = f"{target_date}T{START_HOUR}:00+01:00"
-    end_time = f"{target_date}T{END_HOUR}:00+01:00"
-    dates_list = [{"startTime": start_time, "endTime": end_time}]
+def cache_spaces(ttl: float):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(session: requests.Session, start_time: str, end_time: str, dates_json: str, location_id: str) -> list[str] | None:
+            key = (start_time, end_time, location_id)
+            cached = _spaces_cache.get(key)
+            if cached and cached[0] > time.monotonic():
+                logging.debug("Using cached spaces for %s - %s at location %s.", start_time, end_time, location_id)
+                return cached[1]
+            spaces = func(session, start_time, end_time, dates_json, location_id)
+            if spaces:
+                _spaces_cache[key] = (time.monotonic() + ttl, spaces)
+            return spaces
+        return wrapper
+    return decorator
+
+def invalidate_cached_spaces(start_time: str, end_time: str, location_id: str) -> None:
+    _spaces_cache.pop((start_time, end_time, location_id), None)
+
+def has_cached_spaces(start_time: str, end_time: str, location_id: str) -> bool:
+    cached = _spaces_cache.get((start_time, end_time, location_id))
+    return bool(cached) and cached[0] > time.monotonic()
+
+@cache_spaces(SPACES_CACHE_TTL)
+def get_available_spaces(session: requests.Session, start_time: str, end_time: str, dates_json: str, location_id: str) -> list[str] | None:
+    logging.info("Fetching available spaces for %s - %s at location %s...", start_time, end_time, location_id)
+    search_url = f"{BASE_URL}/api/2.0/search-resource"
 
     payload = {
         "startTime": start_time,
         "endTime": end_time,
-        "dates": json.dumps(dates_list),
+        "dates": dates_json,
         "type": "parking",
-        "emailAddress": f"{MAIL_USER}",
+        "emailAddress": MAIL_USER,
         "lang": "pl"
     }
 
     try:
-        response = session.post(search_url, headers=headers, data=payload)
+        response = post_auth(session, search_url, payload)
         response.raise_for_status()
-        data = response.json()
-        logging.debug(f"Data: {data}")
+        data = orjson.loads(response.content)
+        logging.debug("Data: %s", data)
         location_data = data.get("locations", {}).get(location_id)
         if not location_data:
-            logging.warning(f"No data found for location ID {location_id}.")
+            logging.warning("No data found for location ID %s.", location_id)
             return []
         resources = location_data.get("resources", [])
         available_spaces = [str(r["id"]) for r in resources if r.get("status") == "free"]
         if not available_spaces:
-            logging.warning(f"No spaces with 'status: free' found at location {location_id}!")
+            logging.warning("No spaces with 'status: free' found at location %s!", location_id)
         else:
-            logging.info(f"Extracted free parking spaces at {location_id}: {', '.join(available_spaces)}")
+            logging.info("Extracted free parking spaces at %s: %s", location_id, ", ".join(available_spaces))
         return available_spaces
-    except requests.exceptions.RequestException as e:
-        logging.error(f"An error occurred while fetching spaces: {e}")
+    except requests.exceptions.HTTPError as e:
+        logging.error("An error occurred while fetching spaces: %s", e)
+        if e.response is not None and e.response.status_code in PERMANENT_FETCH_STATUSES:
+            return None
+        # 408, 429 and 5xx are transient; keep polling
         return []
-    except (KeyError, TypeError) as e:
-        logging.error(f"Failed to parse available spaces from response: {e}. Response: {response.text}")
+    except requests.exceptions.RequestException as e:
+        # Connection errors, timeouts and exhausted 5xx retries are transient; keep polling
+        logging.error("An error occurred while fetching spaces: %s", e)
         return []
+    except (orjson.JSONDecodeError, KeyError, TypeError) as e:
+        logging.error("Failed to parse available spaces from response: %s. Response: %s", e, response.text)
+        return None
 
 
-def attempt_booking(session: requests.Session, token: str, target_date: str, space_id: str) -> bool:
-    logging.info(f"Attempting to book parking spot {space_id} for {target_date}...")
+def attempt_booking(session: requests.Session, start_time: str, end_time: str, dates_json: str, space_id: str, location_id: str) -> bool:
+    logging.info("Attempting to book parking spot %s for %s - %s...", space_id, start_time, end_time)
     booking_url = f"{BASE_URL}/api/2.0/create-event"
-    headers = {"Authorization": f"Bearer {token}"}
 
-    start_time = f"{target_date}T{START_HOUR}:00+01:00"
-    end_time = f"{target_date}T{END_HOUR}:00+01:00"
-    dates_list = [{"startTime": start_time, "endTime": end_time}]
-    
     payload = {
-        "emailAddress": f"{MAIL_USER}",
-        "dates": json.dumps(dates_list),
+        "emailAddress": MAIL_USER,
+        "dates": dates_json,
         "startTime": start_time,
         "endTime": end_time,
         "extras": "[]",
@@ -130,21 +213,23 @@ def attempt_booking(session: requests.Session, token: str, target_date: str, spa
     }
 
     try:
-        response = session.post(booking_url, headers=headers, data=payload)
+        response = post_auth(session, booking_url, payload)
         response.raise_for_status()
-        result = response.json().get("result")
+        result = orjson.loads(response.content).get("result")
 
         if result == "success":
-            logging.info(f"Successfully booked parking spot {space_id} for {target_date}.")
+            logging.info("Successfully booked parking spot %s for %s - %s.", space_id, start_time, end_time)
             return True
         else:
-            logging.warning(f"Failed to book parking spot {space_id}. Response: {response.text}")
+            logging.warning("Failed to book parking spot %s. Response: %s", space_id, response.text)
+            # The server answered and refused the space, so the cached inventory for it is stale
+            invalidate_cached_spaces(start_time, end_time, location_id)
             return False
     except requests.exceptions.RequestException as e:
-        logging.error(f"An error occurred during booking attempt for space {space_id}: {e}")
+        logging.error("An error occurred during booking attempt for space %s: %s", space_id, e)
         return False
-    except (KeyError, TypeError) as e:
-        logging.error(f"Failed to parse booking response for space {space_id}: {e}. Response: {response.text}")
+    except (orjson.JSONDecodeError, KeyError, TypeError) as e:
+        logging.error("Failed to parse booking response for space %s: %s. Response: %s", space_id, e, response.text)
         return False
 
 def lambda_handler(event, context):
@@ -156,54 +241,87 @@ def lambda_handler(event, context):
     if not target_date:
         return {"statusCode": 200, "body": "Script not intended to run on weekends."}
 
-    logging.info(f"Target date: {target_date}")
+    logging.info("Target date: %s", target_date)
+    booking_start, booking_end, dates_json = build_dates_json(target_date)
 
     if context and hasattr(context, 'get_remaining_time_in_millis'):
         timeout_ms = context.get_remaining_time_in_millis()
     else:
         timeout_ms = 60000
-    start_time = time.time()
+    deadline = time.monotonic() + timeout_ms / 1000
 
-    with requests.Session() as session:
+    with requests.Session() as session, ThreadPoolExecutor(max_workers=len(LOCATION_IDS)) as executor:
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=HTTP_RETRY)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        booking_adapter = HTTPAdapter(max_retries=BOOKING_RETRY)
+        booking_adapter.poolmanager = adapter.poolmanager  # share warm connections with login/search
+        session.mount(f"{BASE_URL}/api/2.0/create-event", booking_adapter)
         session.headers.update({
+            'Connection': 'keep-alive',
             'Content-Type': 'application/x-www-form-urlencoded',
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.36'
         })
 
+        warm_up = threading.Thread(target=warm_connection, args=(session,), daemon=True)
+        warm_up.start()
         token = login(session)
+        warm_up.join(WARM_UP_TIMEOUT)
         if not token:
             return {"statusCode": 500, "body": "Login failed"}
+        session.headers["Authorization"] = f"Bearer {token}"
 
-        forbidden_spaces = {"68": "2592", "69": "2591"}
-        sleep_interval = 5
+        delay = INITIAL_RETRY_DELAY
+        last_available_count = None
+        failed_fetch_cycles = 0
 
         while True:
-            all_available = {}
-            for loc_id in LOCATION_IDS:
-                all_available[loc_id] = get_available_spaces(session, token, target_date, loc_id)
+            fetched = not all(has_cached_spaces(booking_start, booking_end, loc_id) for loc_id in LOCATION_IDS)
+            results = executor.map(
+                lambda loc_id: get_available_spaces(session, booking_start, booking_end, dates_json, loc_id),
+                LOCATION_IDS
+            )
+            all_available = dict(zip(LOCATION_IDS, results))
+            if all(spaces is None for spaces in all_available.values()):
+                failed_fetch_cycles += 1
+                if failed_fetch_cycles >= MAX_FAILED_FETCH_CYCLES:
+                    logging.error("Fetching available spaces failed %s times in a row. Giving up.", failed_fetch_cycles)
+                    return {"statusCode": 500, "body": "Failed to fetch available spaces"}
+            else:
+                failed_fetch_cycles = 0
+            all_available = {loc_id: spaces or [] for loc_id, spaces in all_available.items()}
+            available_count = sum(len(spaces) for spaces in all_available.values())
+            if available_count != last_available_count:
+                delay = INITIAL_RETRY_DELAY
+                last_available_count = available_count
 
-            booked = False
+            preferred, forbidden_candidates, seen = [], [], set()
             for loc_id in LOCATION_IDS:
                 for space_id in all_available[loc_id]:
-                    if space_id not in forbidden_spaces.values():
-                        if attempt_booking(session, token, target_date, space_id):
-                            return {"statusCode": 200, "body": f"Booked space {space_id} at location {loc_id}"}
-                        logging.warning(f"Failed to book space {space_id} at location {loc_id}. Trying next available space...")
+                    if space_id in seen:
+                        continue
+                    seen.add(space_id)
+                    (forbidden_candidates if space_id in FORBIDDEN_SPACES else preferred).append((loc_id, space_id))
+            random.shuffle(preferred)
+
+            for loc_id, space_id in preferred:
+                if attempt_booking(session, booking_start, booking_end, dates_json, space_id, loc_id):
+                    return {"statusCode": 200, "body": f"Booked space {space_id} at location {loc_id}"}
+                logging.warning("Failed to book space %s at location %s. Trying next available space...", space_id, loc_id)
 
-            forbidden_candidates = []
-            for loc_id in LOCATION_IDS:
-                forbidden_candidates.extend([sid for sid in all_available[loc_id] if sid in forbidden_spaces.values()])
             if forbidden_candidates:
-                space_id = random.choice(forbidden_candidates)
-                if attempt_booking(session, token, target_date, space_id):
+                loc_id, space_id = random.choice(forbidden_candidates)
+                if attempt_booking(session, booking_start, booking_end, dates_json, space_id, loc_id):
                     return {"statusCode": 200, "body": f"Booked forbidden space {space_id}"}
-                logging.warning(f"Failed to book forbidden space {space_id}. Retrying...")
+                logging.warning("Failed to book forbidden space %s. Retrying...", space_id)
 
             logging.warning("No available spaces could be booked. Retrying...")
-            elapsed = time.time() - start_time
-            if elapsed + sleep_interval > timeout_ms / 1000:
+            sleep_for = delay + random.uniform(0, 0.3)
+            if time.monotonic() + sleep_for > deadline:
                 break
-            time.sleep(sleep_interval)
+            time.sleep(sleep_for)
+            if fetched:
+                delay = min(delay * RETRY_BACKOFF_FACTOR, MAX_RETRY_DELAY)
 
     logging.warning("No available spaces could be booked after retries.")
     return {"statusCode": 404, "body": "No available spaces could be booked after retries."}